@@ -2,14 +2,17 @@
 Async Call Tracing - Track async task creation and execution paths
 
 This library helps debug async code by tracking task creation and execution paths.
-It monkey-patches asyncio.create_task() to record parent-child relationships between tasks.
+It installs an asyncio.Task subclass (and wraps custom loop task factories) to record
+parent-child relationships between tasks.
 
 Public API:
     collect_async_trace() -> dict: Collect structured trace data
     print_async_trace(trace_data): Print formatted trace
     print_trace(): Convenience function (collect + print)
-    enable_tracing(): Enable the async tracing (done automatically on import)
+    enable_tracing(max_depth=None): Enable the async tracing (done automatically on
+        import unless the ASYNC_TRACE environment variable is set to "0")
     disable_tracing(): Disable the async tracing
+    trace_region(): Context manager tracing tasks created inside it, even while disabled
 
 Example:
     ```python
@@ -29,12 +32,15 @@ Example:
 For more information, see the documentation or examples.
 """
 
+import os
+
 from .tracer import (
     collect_async_trace,
     print_async_trace,
     print_trace,
     enable_tracing,
     disable_tracing,
+    trace_region,
 )
 
 __version__ = "0.1.0"
@@ -45,8 +51,10 @@ __all__ = [
     "print_trace",
     "enable_tracing",
     "disable_tracing",
+    "trace_region",
 ]
 
-# Enable tracing by default when the module is imported
-enable_tracing()
+# Enable tracing by default when the module is imported, unless ASYNC_TRACE=0
+if os.environ.get("ASYNC_TRACE", "1") != "0":
+    enable_tracing()
 
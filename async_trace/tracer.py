@@ -1,81 +1,352 @@
 """
 Core async tracing functionality.
 
-This module implements the async call tracing by monkey-patching asyncio.create_task()
-to track parent-child relationships between async tasks.
+This module implements the async call tracing by swapping in an asyncio.Task subclass
+that tracks parent-child relationships between async tasks.
 """
 
 import asyncio
-import traceback
-from typing import Dict, List, Any
+import contextvars
+import os
+import sys
+import weakref
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Collection, Dict, List, Optional, Sequence, Tuple
 
 
-# Track parent relationships and stack traces
-_task_parents: Dict[asyncio.Task, Dict[str, Any]] = {}
+# Track parent relationships and stack traces (entries go away with their tasks)
+_task_parents: "weakref.WeakKeyDictionary[asyncio.Task, _TaskInfo]" = weakref.WeakKeyDictionary()
 
-# Store original create_task function
-_orig_create_task = None
+# Upper bound on the number of frames captured per stack walk (see enable_tracing())
+_MAX_TRACE_DEPTH = 64
+
+# Upper bound on the number of task levels walked by collect_async_trace()
+_MAX_TASK_DEPTH = 1024
+
+# Module-level binding of the (C-accelerated) current_task lookup
+_current_task = asyncio.current_task
+
+# Whether the tracing hooks are installed; they are never removed, only gated
+# by _tracing_enabled and _region_active
+_installed = False
 _tracing_enabled = False
 
+# Original task factory accessors, called through by the installed replacements
+_orig_set_task_factory = asyncio.BaseEventLoop.set_task_factory
+_orig_get_task_factory = asyncio.BaseEventLoop.get_task_factory
+
+# Set inside trace_region(); inherited by tasks created there, like any context var
+_region_active: "contextvars.ContextVar[bool]" = contextvars.ContextVar('async_trace_region', default=False)
+
+# Source files of asyncio internals hidden from traces (exact paths, so this
+# works with any path separator and never matches user files by accident)
+_ASYNCIO_FILES = frozenset(
+    sys.intern(module.__file__)
+    for module in (asyncio.tasks, asyncio.base_events, getattr(asyncio, 'taskgroups', None))
+    if module is not None
+)
+
+# The tracer's own frames are also hidden, both from the current stack and from
+# creation traces of tasks recorded by the task factory wrapper
+_HIDDEN_FILES = _ASYNCIO_FILES | {sys.intern(__file__)}
 
-def _capture_stack(skip: int = 2) -> List[str]:
-    """Capture readable stack trace lines."""
-    return traceback.format_list(traceback.extract_stack()[:-skip])
 
+# Filenames repeat heavily across traces, so cache their shortened form
+_basename = lru_cache(maxsize=1024)(os.path.basename)
 
-def _traced_create_task(coro, *args, **kwargs) -> asyncio.Task:
-    """Intercept asyncio.create_task() to record parent relationships."""
-    parent = asyncio.current_task()
-    stack = _capture_stack()
+# Precomputed indent strings for print_async_trace()
+_INDENTS = tuple("  " * i for i in range(128))
+
+# Internal frame record (call traces and the current stack); the public frames
+# returned by collect_async_trace() stay plain dicts
+_Frame = namedtuple('_Frame', 'name line filename')
+
+
+def _walk_stack(stop_keys: Collection[Tuple[str, int]] = (), skip: int = 1) -> List[_Frame]:
+    """
+    Walk the live Python stack (outermost → innermost) without touching linecache.
+    
+    Only user code frames are returned (not asyncio internals or the tracer itself),
+    taken from the innermost _MAX_TRACE_DEPTH frames. The walk stops (exclusive) at
+    the first frame, going outward, whose (name, line) is in stop_keys.
+    """
+    stack = []
+    f = sys._getframe(skip + 1)
+    depth = _MAX_TRACE_DEPTH
+    while f is not None and depth:
+        code = f.f_code
+        # Filter while walking so skipped frames never get a record
+        if code.co_filename not in _HIDDEN_FILES:
+            if (code.co_name, f.f_lineno) in stop_keys:
+                break
+            stack.append(_Frame(code.co_name, f.f_lineno, code.co_filename))
+        f = f.f_back
+        depth -= 1
+    stack.reverse()
+    return stack
+
+
+class _TaskInfo:
+    """
+    Tracing record kept in _task_parents for each traced task.
+    
+    Records never hold a strong reference to a task: a _task_parents value that
+    reaches its own key (e.g. through a failed parent's traceback, whose frame
+    still holds the child) would keep the entry alive forever. Ancestry is
+    chained through the parents' records instead, so it outlives the parents.
+    """
+    
+    __slots__ = ('task', 'parent', 'name', 'call_trace_raw', 'call_trace', 'ancestors')
+    
+    def __init__(self, task: asyncio.Task, parent: Optional['_TaskInfo'],
+                 call_trace_raw: Optional[list]):
+        self.task = weakref.ref(task)
+        self.parent = parent
+        # Root records keep the task's name for when the task itself is gone
+        self.name: Optional[str] = None if parent is not None else task.get_name()
+        # Raw (code, lineno) creation snapshot, innermost first; replaced by
+        # call_trace once resolved
+        self.call_trace_raw = call_trace_raw
+        self.call_trace: Optional[List[_Frame]] = None
+        # Memoized records from the root down to the parent
+        self.ancestors: Optional[tuple] = None
+
+
+def _resolve_call_trace(task_info: _TaskInfo) -> Sequence[_Frame]:
+    """
+    Resolve a task's raw creation snapshot into call trace frames.
+    
+    The result is stored back on task_info, so each task is resolved at most once.
+    """
+    call_trace = task_info.call_trace
+    if call_trace is not None:
+        return call_trace
+    
+    raw = task_info.call_trace_raw
+    if raw is None:
+        return ()
     
-    # Also capture the current Python call stack at creation time
-    current_stack = traceback.extract_stack()
     call_trace = []
-    for frame in reversed(current_stack):
-        # Skip internal tracing functions
-        if frame.name in ['_traced_create_task', '_capture_stack']:
-            continue
-        # Only include frames from user code (not from asyncio internals)
-        if not frame.filename.endswith(('asyncio/tasks.py', 'asyncio/base_events.py')):
-            call_trace.insert(0, {
-                'name': frame.name,
-                'line': frame.lineno,
-                'code': frame.line,
-                'filename': frame.filename
-            })
-    
-    task = _orig_create_task(coro, *args, **kwargs)
-    _task_parents[task] = {
-        "parent": parent,
-        "stack": stack,
-        "call_trace": call_trace
-    }
-    return task
+    # The raw snapshot is innermost first; the call trace is outermost first
+    for code, lineno in reversed(raw):
+        # Only include frames from user code (not from asyncio internals or the
+        # task factory wrapper)
+        if code.co_filename not in _HIDDEN_FILES:
+            # Intern so long-lived traces share one copy of each name and path
+            # (a no-op for most compiled code, where these are already shared)
+            call_trace.append(_Frame(sys.intern(code.co_name), lineno, sys.intern(code.co_filename)))
+    
+    task_info.call_trace = call_trace
+    task_info.call_trace_raw = None
+    return call_trace
+
+
+def _task_chain(task_info: _TaskInfo) -> tuple:
+    """
+    Return the _TaskInfo records from the root task down to task_info.
+    
+    A task's ancestry never changes, so each _TaskInfo memoizes the chain of its
+    ancestors and descendants reuse it instead of walking the parents again.
+    """
+    # Walk up to the nearest record with memoized ancestors (or the root).
+    # Parent chains are acyclic in practice; the depth cap only guards against
+    # a corrupted chain looping forever
+    pending = []
+    chain = ()
+    while task_info is not None and len(pending) < _MAX_TASK_DEPTH:
+        if task_info.ancestors is not None:
+            chain = task_info.ancestors + (task_info,)
+            break
+        pending.append(task_info)
+        task_info = task_info.parent
+    
+    # Extend the chain back down, memoizing each record's ancestors on the way
+    for task_info in reversed(pending):
+        task_info.ancestors = chain
+        chain += (task_info,)
+    return chain
+
+
+def _record_task(task: asyncio.Task, parent: asyncio.Task, f):
+    """Record task's parent and its creation stack, starting from frame f."""
+    # Snapshot the call stack as raw (code, lineno) pairs; names and filenames
+    # are only resolved if the trace is actually collected
+    call_trace_raw = []
+    depth = _MAX_TRACE_DEPTH
+    while f is not None and depth:
+        call_trace_raw.append((f.f_code, f.f_lineno))
+        f = f.f_back
+        depth -= 1
+    
+    # Tasks started outside any task (or while tracing was off) get a root record
+    # the first time they create a traced child
+    parent_info = _task_parents.get(parent)
+    if parent_info is None:
+        parent_info = _task_parents[parent] = _TaskInfo(parent, None, None)
+    _task_parents[task] = _TaskInfo(task, parent_info, call_trace_raw)
+
+
+class _TracedTask(asyncio.Task):
+    """
+    asyncio.Task subclass that records its parent task and creation stack.
+    
+    Installed as asyncio.tasks.Task, which is what loop.create_task() instantiates,
+    so tasks created through asyncio.create_task(), ensure_future(), gather() and
+    TaskGroup are all traced. Loops with a custom task factory are covered by
+    _TracedTaskFactory instead.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        # Record before initializing: an eagerly started task may run (and
+        # collect its trace) from inside Task.__init__()
+        if _tracing_enabled or _region_active.get():
+            # loop.create_task() passes the loop, which need not be running yet
+            try:
+                parent = _current_task(kwargs.get('loop'))
+            except RuntimeError:
+                parent = None
+            # Tasks started outside any task (e.g. the asyncio.run() main task)
+            # are roots and are shown by name
+            if parent is not None:
+                _record_task(self, parent, sys._getframe(1))
+        super().__init__(*args, **kwargs)
+
+
+# Keep task reprs identical to plain asyncio tasks
+_TracedTask.__name__ = _TracedTask.__qualname__ = 'Task'
+
+
+class _TracedTaskFactory:
+    """
+    Loop task factory wrapper that traces tasks built without _TracedTask.
+    
+    Custom task factories (including asyncio.eager_task_factory) may construct
+    tasks from a Task class bound before tracing was installed; those tasks are
+    recorded here, once the wrapped factory returns them.
+    """
+    
+    __slots__ = ('factory',)
+    
+    def __init__(self, factory):
+        self.factory = factory
+    
+    def __call__(self, loop, coro, **kwargs):
+        task = self.factory(loop, coro, **kwargs)
+        if (_tracing_enabled or _region_active.get()) and not isinstance(task, _TracedTask):
+            parent = _current_task(loop)
+            if parent is not None:
+                _record_task(task, parent, sys._getframe(1))
+        return task
 
 
-def enable_tracing():
-    """Enable async call tracing by monkey-patching asyncio.create_task()."""
-    global _orig_create_task, _tracing_enabled
+def _set_task_factory(loop, factory):
+    """BaseEventLoop.set_task_factory() replacement that wraps the factory for tracing."""
+    # Non-callables are passed through for the original to reject
+    if callable(factory):
+        factory = _TracedTaskFactory(factory)
+    _orig_set_task_factory(loop, factory)
+
+
+def _get_task_factory(loop):
+    """BaseEventLoop.get_task_factory() replacement that hides the tracing wrapper."""
+    factory = _orig_get_task_factory(loop)
+    if isinstance(factory, _TracedTaskFactory):
+        return factory.factory
+    return factory
+
+
+def _install_task_class():
+    """Install the tracing Task subclass and task factory hooks, once; later calls do nothing."""
+    global _installed
+    
+    if not _installed:
+        _installed = True
+        asyncio.tasks.Task = _TracedTask
+        asyncio.BaseEventLoop.set_task_factory = _set_task_factory
+        asyncio.BaseEventLoop.get_task_factory = _get_task_factory
+
+
+def enable_tracing(max_depth: Optional[int] = None):
+    """
+    Enable async call tracing by installing the tracing asyncio.Task subclass.
+    
+    Task factories set on asyncio event loops are wrapped so that their tasks are
+    traced too. uvloop builds its tasks without either hook and is not traced.
+    
+    Args:
+        max_depth: Maximum number of Python frames captured per stack walk
+            (default 64). Frames beyond it, outermost first, are left out of traces.
+            The limit stays in effect across calls: None leaves it unchanged, so
+            pass 64 to restore the default.
+    """
+    global _tracing_enabled, _MAX_TRACE_DEPTH
+    
+    if max_depth is not None:
+        if max_depth < 1:
+            raise ValueError("max_depth must be at least 1")
+        _MAX_TRACE_DEPTH = max_depth
     
     if _tracing_enabled:
         return
     
-    _orig_create_task = asyncio.create_task
-    asyncio.create_task = _traced_create_task
+    _install_task_class()
     _tracing_enabled = True
 
 
 def disable_tracing():
-    """Disable async call tracing by restoring the original asyncio.create_task()."""
-    global _tracing_enabled
+    """
+    Disable async call tracing.
     
-    if not _tracing_enabled:
-        return
+    The tracing Task subclass and task factory wrapper stay installed, but they no
+    longer capture anything outside of trace_region() blocks.
+    """
+    global _tracing_enabled
     
-    asyncio.create_task = _orig_create_task
     _tracing_enabled = False
 
 
+@contextmanager
+def trace_region():
+    """
+    Trace tasks created inside this block, even while tracing is disabled.
+    
+    The region is tracked with a context variable, so tasks created inside it
+    (and, in turn, their children) keep being traced after the block exits.
+    
+    Example:
+        ```python
+        disable_tracing()
+        
+        async def handler():
+            with trace_region():
+                await asyncio.create_task(worker())  # traced
+        ```
+    """
+    _install_task_class()
+    token = _region_active.set(True)
+    try:
+        yield
+    finally:
+        _region_active.reset(token)
+
+
+def _emit_current(frames: List[Dict[str, Any]], indent: int,
+                  current_stack: List[_Frame]) -> int:
+    """Write the current task's own stack frames into frames, returning the next indent."""
+    for frame_data in current_stack:
+        frames[indent] = {
+            'name': frame_data.name,
+            'line': frame_data.line,
+            'filename': frame_data.filename,
+            'indent': indent,
+            'task': None
+        }
+        indent -= 1
+    return indent
+
+
 def collect_async_trace() -> Dict[str, Any]:
     """
     Collect structured async call trace data as a flat list of frames.
@@ -88,144 +359,84 @@ def collect_async_trace() -> Dict[str, Any]:
                 - 'filename': str | None - Full file path (None for root task)
                 - 'indent': int - 0=innermost, higher=outermost
                 - 'task': Task | None - Task object if this frame creates/is a task
-            - 'current_task': Task - The current asyncio task
+                  (None as well if that task has finished and been garbage collected)
+            - 'current_task': Task | None - The current asyncio task (None outside a task)
     
     Notes:
         - Frames are ordered from innermost (current execution) to outermost (root)
         - Task boundaries are marked by frames where 'task' is not None
         - All frames have the same structure (some fields may be None)
     """
-    current_task = asyncio.current_task()
+    try:
+        current_task = _current_task()
+    except RuntimeError:
+        # No running event loop
+        current_task = None
     
-    # Build the task chain hierarchy first
+    # Nothing to trace outside of a task
+    if current_task is None:
+        return {
+            'frames': [],
+            'current_task': None
+        }
+    
+    # Build the task chain hierarchy first (root first). Ancestors that have
+    # finished and been collected are shown from their records, with no task
+    current_info = _task_parents.get(current_task)
+    if current_info is None:
+        current_info = _TaskInfo(current_task, None, None)
     task_chain = []
-    task = current_task
-    visited_tasks = set()
+    for task_info in _task_chain(current_info):
+        task_chain.append({
+            'task': task_info.task(),
+            'name': task_info.name,
+            'is_current': task_info is current_info,
+            'call_trace': _resolve_call_trace(task_info)
+        })
+    current_call_trace = task_chain[-1]['call_trace']
     
-    while task and task not in visited_tasks:
-        task_info = _task_parents.get(task, {})
-        
-        task_data = {
-            'task': task,
-            'name': task.get_name() if hasattr(task, 'get_name') else f"Task-{id(task)}",
-            'is_current': task == current_task,
-            'is_done': task.done() if hasattr(task, 'done') else False,
-            'parent': task_info.get('parent'),
-            'call_trace': task_info.get('call_trace', []),
-            'creation_stack': task_info.get('stack', [])
-        }
-        
-        task_chain.insert(0, task_data)
-        visited_tasks.add(task)
-        task = task_info.get("parent")
-    
-    # Collect current call stack (only frames within the current task)
-    stack_frames = traceback.extract_stack()
-    task_info = _task_parents.get(current_task, {})
-    call_trace = task_info.get('call_trace', [])
-    
-    # Find where the current task starts in the stack
-    creation_frame_indices = set()
-    if call_trace:
-        for i, frame in enumerate(stack_frames):
-            for trace_frame in call_trace:
-                if (frame.name == trace_frame['name'] and 
-                    frame.lineno == trace_frame['line']):
-                    creation_frame_indices.add(i)
-    
-    max_creation_idx = max(creation_frame_indices) if creation_frame_indices else -1
-    
-    current_stack = []
-    for i, frame in enumerate(stack_frames):
-        if i <= max_creation_idx:
-            continue
-        # Skip internal tracing functions
-        if frame.name in ['collect_async_trace', 'print_async_trace', 'print_trace']:
-            continue
-        # Only include user code frames
-        if not frame.filename.endswith(('tracer.py', 'asyncio/tasks.py', 'asyncio/base_events.py')):
-            current_stack.append({
-                'name': frame.name,
-                'line': frame.lineno,
-                'code': frame.line,
-                'filename': frame.filename
-            })
-    
-    # Now flatten everything into a simple linear trace with unified structure
-    frames = []
-    indent = 0
+    # Collect current call stack (only frames within the current task): walk
+    # outward from here and stop at the innermost frame that matches the
+    # current task's creation point, so outer frames are never visited
+    creation_keys = {(tf.name, tf.line) for tf in current_call_trace}
+    current_stack = _walk_stack(creation_keys)
+    
+    # Now flatten everything into a simple linear trace with unified structure.
+    # Frames are produced outermost first, so size the list up front and fill
+    # it from the end: a frame's position equals its final (inner → outer) indent.
+    total = 0
+    for task_data in task_chain:
+        total += len(task_data['call_trace']) or 1
+        if task_data['is_current']:
+            total += len(current_stack)
+    frames: List[Dict[str, Any]] = [None] * total
+    indent = total - 1
     
     for task_data in task_chain:
         call_trace = task_data['call_trace']
-        is_current = task_data['is_current']
         
-        # If no call trace, it's a root task
+        # A root task has no call trace; its name stands in for the creation point
         if not call_trace:
-            frames.append({
-                'name': task_data['name'],
-                'line': None,
-                'filename': None,
+            task = task_data['task']
+            name = task.get_name() if task is not None else task_data['name']
+            call_trace = (_Frame(name, None, None),)
+        
+        # Add call trace frames; the last one is the task creation point and
+        # is marked with the task boundary
+        last = len(call_trace) - 1
+        for j, trace_frame in enumerate(call_trace):
+            frames[indent] = {
+                'name': trace_frame.name,
+                'line': trace_frame.line,
+                'filename': trace_frame.filename,
                 'indent': indent,
-                'task': task_data['task']
-            })
-            indent += 1
-            
-            # Add current stack frames if this is the current root task
-            if is_current:
-                for frame_data in current_stack:
-                    frames.append({
-                        'name': frame_data['name'],
-                        'line': frame_data['line'],
-                        'filename': frame_data.get('filename'),
-                        'indent': indent,
-                        'task': None
-                    })
-                    indent += 1
-        else:
-            # Add call trace frames
-            for j, trace_frame in enumerate(call_trace):
-                is_last = j == len(call_trace) - 1
-                
-                if is_last:
-                    # This is the task creation point - mark with task boundary
-                    frames.append({
-                        'name': trace_frame['name'],
-                        'line': trace_frame['line'],
-                        'filename': trace_frame.get('filename'),
-                        'indent': indent,
-                        'task': task_data['task']
-                    })
-                    indent += 1
-                    
-                    # Add current stack frames if this is the current task
-                    if is_current:
-                        for frame_data in current_stack:
-                            frames.append({
-                                'name': frame_data['name'],
-                                'line': frame_data['line'],
-                                'filename': frame_data.get('filename'),
-                                'indent': indent,
-                                'task': None
-                            })
-                            indent += 1
-                else:
-                    # Regular call frame
-                    frames.append({
-                        'name': trace_frame['name'],
-                        'line': trace_frame['line'],
-                        'filename': trace_frame.get('filename'),
-                        'indent': indent,
-                        'task': None
-                    })
-                    indent += 1
-    
-    # Reverse frames to go from inner (current) to outer (root)
-    frames.reverse()
-    
-    # Recalculate indents for the reversed order
-    max_indent = max((f['indent'] for f in frames), default=0)
-    for frame in frames:
-        frame['indent'] = max_indent - frame['indent']
+                'task': task_data['task'] if j == last else None
+            }
+            indent -= 1
+        
+        # Add current stack frames if this is the current task
+        if task_data['is_current']:
+            indent = _emit_current(frames, indent, current_stack)
     
     return {
         'frames': frames,
@@ -240,24 +451,30 @@ def print_async_trace(trace_data: Dict[str, Any]):
     Args:
         trace_data: The trace data dict returned by collect_async_trace()
     """
-    frames = trace_data['frames']
-    for frame in frames:
-        indent = "  " * frame['indent']
+    lines = []
+    for frame in trace_data['frames']:
+        depth = frame['indent']
+        indent = _INDENTS[depth] if depth < 128 else "  " * depth
         name = frame['name']
         line = frame['line']
-        filename = frame.get('filename')
+        filename = frame['filename']
         
         # Format the line info
         if line is not None:
             # Show shortened filename if available
             file_display = ""
             if filename:
-                file_display = f" [{filename}]"
+                file_display = f" [{_basename(filename)}]"
             
-            print(f"{indent}↑ {name}() at line {line}{file_display}")
+            lines.append(f"{indent}↑ {name}() at line {line}{file_display}")
         else:
             # Root task without line number
-            print(f"{indent}↑ {name}")
+            lines.append(f"{indent}↑ {name}")
+    
+    # Write the whole trace at once rather than one print() per frame
+    if lines:
+        lines.append("")
+        sys.stdout.write("\n".join(lines))
 
 
 def print_trace():
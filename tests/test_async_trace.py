@@ -0,0 +1,185 @@
+import asyncio
+import gc
+import sys
+import unittest
+
+from async_trace import collect_async_trace, disable_tracing, enable_tracing, trace_region, tracer
+
+
+async def _leaf():
+    await asyncio.sleep(0)
+    return [frame['name'] for frame in collect_async_trace()['frames']]
+
+
+async def _spawn():
+    return await asyncio.create_task(_leaf())
+
+
+def _run_with_factory(factory):
+    async def main():
+        asyncio.get_running_loop().set_task_factory(factory)
+        return await _spawn()
+    
+    return asyncio.run(main())
+
+
+class TaskFactoryTest(unittest.TestCase):
+    def test_custom_task_factory_is_traced(self):
+        names = _run_with_factory(lambda loop, coro, **kwargs: asyncio.Task(coro, loop=loop, **kwargs))
+        self.assertEqual(names[:3], ['_leaf', '_spawn', 'main'])
+    
+    @unittest.skipIf(sys.version_info < (3, 12), "eager tasks need Python 3.12+")
+    def test_eager_task_factory_is_traced(self):
+        names = _run_with_factory(asyncio.eager_task_factory)
+        self.assertEqual(names[:3], ['_leaf', '_spawn', 'main'])
+    
+    def test_get_task_factory_returns_the_factory_set(self):
+        def factory(loop, coro, **kwargs):
+            return asyncio.Task(coro, loop=loop, **kwargs)
+        
+        loop = asyncio.new_event_loop()
+        try:
+            loop.set_task_factory(factory)
+            self.assertIs(loop.get_task_factory(), factory)
+        finally:
+            loop.close()
+
+
+class _Result:
+    pass
+
+
+class TaskParentsTest(unittest.TestCase):
+    def test_task_parents_drain_after_collect(self):
+        async def worker():
+            collect_async_trace()
+            return _Result()
+        
+        async def main():
+            for _ in range(100):
+                await asyncio.create_task(worker())
+            await asyncio.sleep(0)
+        
+        asyncio.run(main())
+        gc.collect()
+        self.assertEqual(len(tracer._task_parents), 0)
+        self.assertFalse(any(isinstance(obj, _Result) for obj in gc.get_objects()))
+    
+    def test_task_parents_drain_after_parent_fails(self):
+        async def child():
+            collect_async_trace()
+            return _Result()
+        
+        async def parent():
+            task = asyncio.create_task(child())
+            await task
+            raise KeyError
+        
+        for _ in range(100):
+            try:
+                asyncio.run(parent())
+            except KeyError:
+                pass
+        gc.collect()
+        self.assertEqual(len(tracer._task_parents), 0)
+        self.assertFalse(any(isinstance(obj, _Result) for obj in gc.get_objects()))
+    
+    def test_fire_and_forget_ancestry_outlives_parent(self):
+        async def grandchild():
+            # Let the parent finish and be collected first
+            await asyncio.sleep(0.01)
+            gc.collect()
+            return [frame['name'] for frame in collect_async_trace()['frames']]
+        
+        async def child():
+            return asyncio.create_task(grandchild())
+        
+        async def main():
+            grandchild_task = await asyncio.create_task(child())
+            return await grandchild_task
+        
+        names = asyncio.run(main())
+        self.assertEqual(names[:2], ['grandchild', 'child'])
+        self.assertIn('main', names)
+
+
+
+class TraceRegionTest(unittest.TestCase):
+    def setUp(self):
+        disable_tracing()
+    
+    def tearDown(self):
+        enable_tracing()
+    
+    def test_task_created_inside_region_is_traced(self):
+        async def main():
+            with trace_region():
+                return await asyncio.create_task(_leaf())
+        
+        names = asyncio.run(main())
+        self.assertEqual(names[:2], ['_leaf', 'main'])
+    
+    def test_task_created_outside_region_is_not_traced(self):
+        async def main():
+            with trace_region():
+                pass
+            return await asyncio.create_task(_leaf())
+        
+        names = asyncio.run(main())
+        self.assertEqual(names[0], '_leaf')
+        self.assertNotIn('main', names)
+    
+    def test_region_descendants_stay_traced_after_exit(self):
+        async def child():
+            # Runs after main() has left the region
+            return await asyncio.create_task(_leaf())
+        
+        async def main():
+            with trace_region():
+                task = asyncio.create_task(child())
+            return await task
+        
+        names = asyncio.run(main())
+        self.assertEqual(names[:2], ['_leaf', 'child'])
+        self.assertIn('main', names)
+
+
+
+class MaxDepthTest(unittest.TestCase):
+    def tearDown(self):
+        enable_tracing(max_depth=64)
+    
+    def test_max_depth_below_one_is_rejected(self):
+        enable_tracing(max_depth=10)
+        for max_depth in (0, -1):
+            with self.assertRaises(ValueError):
+                enable_tracing(max_depth=max_depth)
+        self.assertEqual(tracer._MAX_TRACE_DEPTH, 10)
+    
+    def test_max_depth_truncates_traces(self):
+        async def deep(n):
+            if n:
+                return await deep(n - 1)
+            return await asyncio.create_task(_leaf())
+        
+        async def main():
+            return await deep(30)
+        
+        names = asyncio.run(main())
+        self.assertEqual(names.count('deep'), 31)
+        
+        enable_tracing(max_depth=5)
+        names = asyncio.run(main())
+        self.assertEqual(names[0], '_leaf')
+        self.assertIn(names.count('deep'), range(1, 6))
+    
+    def test_max_depth_none_keeps_the_limit(self):
+        enable_tracing(max_depth=5)
+        enable_tracing()
+        self.assertEqual(tracer._MAX_TRACE_DEPTH, 5)
+        enable_tracing(max_depth=64)
+        self.assertEqual(tracer._MAX_TRACE_DEPTH, 64)
+
+
+if __name__ == '__main__':
+    unittest.main()